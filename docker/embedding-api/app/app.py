@@ -1,29 +1,236 @@
 # app.py
-from fastapi import FastAPI, HTTPException
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from functools import partial
+
+
+def available_cpus() -> int:
+    # The affinity mask covers cpuset pinning only; a CFS quota (--cpus, k8s
+    # limits.cpu) shows up in the cgroup v2 cpu.max file instead.
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max", encoding="utf-8") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+CPU_THREADS = int(os.getenv("TORCH_THREADS", available_cpus()))
+# Must be set before torch/onnxruntime load their OpenMP/MKL runtimes
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_THREADS))
+
+import numpy as np
+import torch
+from cachetools import LRUCache
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 
+torch.set_num_threads(CPU_THREADS)
+
+MODEL_NAME = os.getenv("MODEL_NAME", "all-mpnet-base-v2")
+# onnx (default), openvino for Intel CPUs, or torch for hosts where neither applies
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx").lower()
+# Pins the ONNX graph. When empty, hosts with AVX-512 VNNI use the INT8 graph and
+# the rest use O3, the most optimized FP32 build (O4 is fp16 and GPU-only). The
+# ingest job's local mode applies the same rule; pin ONNX_FILE on both when
+# their hosts differ so one collection never mixes quantizations.
+ONNX_FILE = os.getenv("ONNX_FILE", "")
+ONNX_FILE_VNNI = os.getenv("ONNX_FILE_VNNI", "onnx/model_qint8_avx512_vnni.onnx")
+ONNX_FILE_FALLBACK = os.getenv("ONNX_FILE_FALLBACK", "onnx/model_O3.onnx")
+OPENVINO_FILE = os.getenv("OPENVINO_FILE", "openvino/openvino_model_qint8_quantized.xml")
+# Forward-pass size within a request; encode() length-sorts texts before
+# slicing, so smaller slices are padded to their own longest text only.
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+# Server-side batching: texts from concurrent requests are merged until
+# MAX_BATCH texts are queued or MAX_WAIT_MS passes since the first one.
+MAX_BATCH = int(os.getenv("MAX_BATCH", "64"))
+MAX_WAIT_MS = int(os.getenv("MAX_WAIT_MS", "10"))
+# Embeddings of recently seen texts; short labels like offense types repeat a lot.
+# Each 768-dim entry is ~3 KB, so 10000 entries hold ~30 MB per replica. 0 disables.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+
+
+def cpu_supports_vnni() -> bool:
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            return "avx512_vnni" in f.read()
+    except OSError:
+        return False
+
+
+def select_onnx_file() -> str:
+    if ONNX_FILE:
+        return ONNX_FILE
+    return ONNX_FILE_VNNI if cpu_supports_vnni() else ONNX_FILE_FALLBACK
+
+
+def load_model(file_name: str | None = None) -> SentenceTransformer:
+    if EMBED_BACKEND == "torch":
+        return SentenceTransformer(MODEL_NAME)
+    if EMBED_BACKEND == "openvino":
+        return SentenceTransformer(
+            MODEL_NAME,
+            backend="openvino",
+            model_kwargs={"file_name": file_name or OPENVINO_FILE},
+        )
+    if EMBED_BACKEND != "onnx":
+        raise ValueError(f"Unsupported EMBED_BACKEND '{EMBED_BACKEND}'. Use 'onnx', 'openvino' or 'torch'.")
+
+    # Only the runtime for the image's EMBED_BACKEND is installed
+    import onnxruntime as ort
+
+    if file_name is None:
+        file_name = select_onnx_file()
+
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = CPU_THREADS
+    # ORT's default level, set explicitly so every fusion stays on if the default changes
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # Spread each op across intra-op threads in finer blocks for variable sequence lengths
+    session_options.add_session_config_entry("session.dynamic_block_base", "4")
+
+    return SentenceTransformer(
+        MODEL_NAME,
+        backend="onnx",
+        model_kwargs={
+            "file_name": file_name,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
+
+
 # Load model once at startup (global singleton)
-model = SentenceTransformer("all-mpnet-base-v2")
+model = load_model()
+
+STATUS_TEXT = "The system is running correctly."
+STATUS_EMBEDDING = model.encode(STATUS_TEXT)
+
 
-app = FastAPI(title="Embedding API", version="1.0.0")
+async def batcher(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await queue.get()]
+        count = len(jobs[0][0])
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while count < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            jobs.append(job)
+            count += len(job[0])
+
+        texts = [text for job_texts, _ in jobs for text in job_texts]
+        try:
+            embeddings = await loop.run_in_executor(
+                None, partial(model.encode, texts, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True)
+            )
+        except Exception as exc:
+            for _, future in jobs:
+                if not future.done():
+                    future.set_exception(exc)
+            continue
+
+        offset = 0
+        for job_texts, future in jobs:
+            # Futures of requests whose client went away are already cancelled
+            if not future.done():
+                future.set_result(embeddings[offset : offset + len(job_texts)])
+            offset += len(job_texts)
+
+
+async def enqueue(texts: list[str]) -> np.ndarray:
+    future = asyncio.get_running_loop().create_future()
+    await app.state.queue.put((texts, future))
+    return await future
+
+
+async def embed(texts: list[str]) -> np.ndarray:
+    # The cache is only touched from the event loop thread, so it needs no lock
+    cache = app.state.cache
+    if cache is None:
+        return await enqueue(texts)
+
+    rows = [cache.get(text) for text in texts]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        uncached = list(dict.fromkeys(texts[i] for i in missing))
+        # Copy rows so cache entries do not keep whole batch matrices alive
+        fresh = {text: row.copy() for text, row in zip(uncached, await enqueue(uncached))}
+        cache.update(fresh)
+        for i in missing:
+            rows[i] = fresh[texts[i]]
+    return np.stack(rows)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.queue = asyncio.Queue()
+    app.state.cache = LRUCache(maxsize=EMBED_CACHE_SIZE) if EMBED_CACHE_SIZE > 0 else None
+    task = asyncio.create_task(batcher(app.state.queue))
+    yield
+    task.cancel()
+
+
+# ORJSONResponse serializes numpy arrays straight from their buffers; handlers
+# return it explicitly so FastAPI's jsonable_encoder never walks the arrays.
+app = FastAPI(title="Embedding API", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 
 class EncodeRequest(BaseModel):
     text: str
 
 
+class EncodeBatchRequest(BaseModel):
+    texts: list[str]
+
+
 @app.post("/encode")
-def encode(payload: EncodeRequest):
+async def encode(payload: EncodeRequest):
     if not payload.text.strip():
         raise HTTPException(status_code=400, detail="Text field cannot be empty.")
-    embedding = model.encode(payload.text).tolist()
-    return {"text": payload.text, "embedding": embedding}
+    embedding = (await embed([payload.text]))[0]
+    return ORJSONResponse({"text": payload.text, "embedding": embedding})
+
+
+@app.post("/encode_batch")
+async def encode_batch(payload: EncodeBatchRequest):
+    if not payload.texts:
+        raise HTTPException(status_code=400, detail="Texts field cannot be empty.")
+    embeddings = await embed(payload.texts)
+    return ORJSONResponse({"embeddings": embeddings})
+
+
+@app.post("/encode_batch_bin")
+async def encode_batch_bin(payload: EncodeBatchRequest):
+    """
+    Same as /encode_batch, but the body is a little-endian uint32 row count
+    followed by the (count, dim) float32 matrix in row-major order.
+    """
+    if not payload.texts:
+        raise HTTPException(status_code=400, detail="Texts field cannot be empty.")
+    embeddings = await embed(payload.texts)
+    content = len(payload.texts).to_bytes(4, "little") + embeddings.astype("<f4", copy=False).tobytes()
+    return Response(content=content, media_type="application/octet-stream")
 
 
 @app.get("/status")
 def status():
-    text = "The system is running correctly."
-    embedding = model.encode(text).tolist()
-    print(text)
-    return {"text": text, "embedding": embedding}
\ No newline at end of file
+    return ORJSONResponse({"text": STATUS_TEXT, "embedding": STATUS_EMBEDDING})
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
@@ -0,0 +1,11 @@
+# prefetch.py
+# Run at image build time so the model files for EMBED_BACKEND are already in
+# the Hugging Face cache and container startup never downloads or exports them.
+from app import EMBED_BACKEND, ONNX_FILE, ONNX_FILE_FALLBACK, ONNX_FILE_VNNI, load_model
+
+if __name__ == "__main__":
+    if EMBED_BACKEND == "onnx":
+        for file_name in dict.fromkeys(filter(None, (ONNX_FILE, ONNX_FILE_VNNI, ONNX_FILE_FALLBACK))):
+            load_model(file_name)
+    else:
+        load_model()
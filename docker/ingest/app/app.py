@@ -1,14 +1,25 @@
 import logging
 import os
 import time
-import uuid
-from typing import Iterator, Tuple
+from typing import Tuple
 
-import requests
-from pyspark.sql import SparkSession
+import orjson
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as qmodels
 
+import pipeline
+from pipeline import (
+    ID_COLUMN,
+    QDRANT_COLLECTION,
+    STATS_SCHEMA,
+    TEXT_COLUMN,
+    VECTOR_SIZE,
+    get_client,
+    process_partition,
+)
+
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("spark-qdrant-ingest")
@@ -17,20 +28,12 @@ SPARK_MASTER = os.getenv("SPARK_MASTER", "local[*]")
 SPARK_APP_NAME = os.getenv("SPARK_APP_NAME", "spark-qdrant-ingest")
 INPUT_PATH = os.getenv("INPUT_PATH", "")
 INPUT_FORMAT = os.getenv("INPUT_FORMAT", "parquet").lower()
-ID_COLUMN = os.getenv("ID_COLUMN", "id")
-TEXT_COLUMN = os.getenv("TEXT_COLUMN", "text")
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "64"))
-VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", "768"))
-QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "embeddings")
 QDRANT_DISTANCE = os.getenv("QDRANT_DISTANCE", "cosine")
-QDRANT_HOST = os.getenv("QDRANT_HOST", "databases-qdrant")
-QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))
-QDRANT_URL = os.getenv("QDRANT_URL", "")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
-EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://embedding-api:8000")
-EMBEDDING_ENDPOINT = EMBEDDING_API_URL.rstrip("/") + "/encode"
+QDRANT_WAIT_TIMEOUT = int(os.getenv("QDRANT_WAIT_TIMEOUT", "300"))
+# Only rows with WATERMARK_COLUMN above the last checkpointed value are ingested; empty re-reads everything
+WATERMARK_COLUMN = os.getenv("WATERMARK_COLUMN", "")
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "ingest-checkpoint.json")
 RUN_INTERVAL_SECONDS = int(os.getenv("RUN_INTERVAL_SECONDS", "600"))
-REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
 
 
 def resolve_distance(value: str) -> qmodels.Distance:
@@ -42,12 +45,6 @@ def resolve_distance(value: str) -> qmodels.Distance:
     return qmodels.Distance.COSINE
 
 
-def qdrant_client_kwargs() -> dict:
-    if QDRANT_URL:
-        return {"url": QDRANT_URL, "api_key": QDRANT_API_KEY or None}
-    return {"host": QDRANT_HOST, "port": QDRANT_PORT, "api_key": QDRANT_API_KEY or None}
-
-
 def ensure_collection(client: QdrantClient) -> None:
     try:
         collections = client.get_collections().collections or []
@@ -67,6 +64,24 @@ def ensure_collection(client: QdrantClient) -> None:
     )
 
 
+def wait_for_collection(client: QdrantClient) -> None:
+    # Advisory only: partitions already confirmed their upserts were applied, and
+    # status tracks the optimizers, so green just means indexing has caught up.
+    deadline = time.time() + QDRANT_WAIT_TIMEOUT
+    while True:
+        try:
+            status = client.get_collection(QDRANT_COLLECTION).status
+            if status == qmodels.CollectionStatus.GREEN:
+                return
+        except Exception as exc:
+            logger.warning("Unable to read Qdrant collection status: %s", exc)
+            status = None
+        if time.time() >= deadline:
+            logger.warning("Collection %s not green after %ss (status=%s)", QDRANT_COLLECTION, QDRANT_WAIT_TIMEOUT, status)
+            return
+        time.sleep(1)
+
+
 def build_spark_session() -> SparkSession:
     spark = (
         SparkSession.builder.master(SPARK_MASTER)
@@ -75,6 +90,8 @@ def build_spark_session() -> SparkSession:
         .getOrCreate()
     )
     spark.sparkContext.setLogLevel("WARN")
+    # Ship the executor module so workers import it rather than unpickling it
+    spark.sparkContext.addPyFile(pipeline.__file__)
     return spark
 
 
@@ -90,80 +107,40 @@ def load_dataframe(spark: SparkSession):
     else:
         raise ValueError(f"Unsupported INPUT_FORMAT '{INPUT_FORMAT}'. Use 'csv' or 'parquet'.")
 
-    missing = [col for col in (ID_COLUMN, TEXT_COLUMN) if col not in df.columns]
+    required = (ID_COLUMN, TEXT_COLUMN, WATERMARK_COLUMN) if WATERMARK_COLUMN else (ID_COLUMN, TEXT_COLUMN)
+    missing = [col for col in required if col not in df.columns]
     if missing:
         raise ValueError(f"Missing required columns in dataset: {missing}")
     return df
 
 
-def fetch_embedding(session: requests.Session, text: str):
+def load_checkpoint():
     try:
-        response = session.post(EMBEDDING_ENDPOINT, json={"text": text}, timeout=REQUEST_TIMEOUT)
-        if response.ok:
-            body = response.json()
-            embedding = body.get("embedding")
-            if embedding:
-                return embedding
-            logger.error("Embedding API response missing 'embedding' field.")
-            return None
-        logger.error("Embedding API returned status %s: %s", response.status_code, response.text)
+        with open(CHECKPOINT_PATH, "rb") as f:
+            checkpoint = orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
     except Exception as exc:
-        logger.error("Error calling embedding API: %s", exc)
-    return None
-
-
-def flush_points(client: QdrantClient, points) -> None:
-    if not points:
-        return
-    client.upsert(collection_name=QDRANT_COLLECTION, wait=True, points=points)
-
-
-def process_partition(rows: Iterator) -> Iterator[Tuple[int, int]]:
-    session = requests.Session()
-    client = QdrantClient(**qdrant_client_kwargs())
-    processed = 0
-    failed = 0
-    buffer = []
-
-    for row in rows:
-        payload = row.asDict(recursive=True)
-        text = payload.get(TEXT_COLUMN)
-        if text is None:
-            failed += 1
-            continue
-        text_value = str(text).strip()
-        if not text_value:
-            failed += 1
-            continue
-
-        record_id = payload.get(ID_COLUMN) or str(uuid.uuid4())
-        embedding = fetch_embedding(session, text_value)
-        if embedding is None:
-            failed += 1
-            continue
-
-        payload_clean = {k: v for k, v in payload.items() if v is not None}
-        buffer.append(qmodels.PointStruct(id=str(record_id), vector=embedding, payload=payload_clean))
-
-        if len(buffer) >= BATCH_SIZE:
-            try:
-                flush_points(client, buffer)
-                processed += len(buffer)
-            except Exception as exc:
-                logger.error("Error writing batch to Qdrant: %s", exc)
-                failed += len(buffer)
-            finally:
-                buffer.clear()
-
-    if buffer:
-        try:
-            flush_points(client, buffer)
-            processed += len(buffer)
-        except Exception as exc:
-            logger.error("Error writing final batch to Qdrant: %s", exc)
-            failed += len(buffer)
+        logger.warning("Ignoring unreadable checkpoint %s: %s", CHECKPOINT_PATH, exc)
+        return None
+    if checkpoint.get("column") != WATERMARK_COLUMN:
+        logger.info("Checkpoint is for column %s, not %s; ignoring it.", checkpoint.get("column"), WATERMARK_COLUMN)
+        return None
+    return checkpoint.get("value")
+
+
+def save_checkpoint(value) -> None:
+    tmp_path = CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps({"column": WATERMARK_COLUMN, "value": str(value)}))
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
 
-    return iter([(processed, failed)])
+def filter_new_rows(df: DataFrame, last_seen) -> DataFrame:
+    if last_seen is None:
+        return df
+    column_type = df.schema[WATERMARK_COLUMN].dataType
+    return df.filter(F.col(WATERMARK_COLUMN) > F.lit(last_seen).cast(column_type))
 
 
 def run_ingest() -> Tuple[int, int]:
@@ -172,17 +149,40 @@ def run_ingest() -> Tuple[int, int]:
     df = load_dataframe(spark)
     logger.info("Loaded dataset from %s with schema: %s", INPUT_PATH, df.schema.simpleString())
 
-    client = QdrantClient(**qdrant_client_kwargs())
+    high_water = None
+    if WATERMARK_COLUMN:
+        last_seen = load_checkpoint()
+        df = filter_new_rows(df, last_seen)
+        high_water = df.agg(F.max(WATERMARK_COLUMN)).first()[0]
+        if high_water is None:
+            spark.stop()
+            logger.info("No rows with %s > %s; nothing to ingest.", WATERMARK_COLUMN, last_seen)
+            return 0, 0
+
+    client = get_client()
     ensure_collection(client)
 
-    stats = df.rdd.mapPartitions(process_partition).collect()
+    stats = df.mapInPandas(process_partition, schema=STATS_SCHEMA).collect()
     spark.stop()
 
-    processed = sum(item[0] for item in stats)
-    failed = sum(item[1] for item in stats)
+    processed = sum(item.processed for item in stats)
+    skipped = sum(item.skipped for item in stats)
+    failed = sum(item.failed for item in stats)
+
+    # Rows past the old watermark that failed would be skipped forever, so only
+    # move it once every embed and upsert succeeded; blank texts never block it
+    if high_water is not None:
+        if failed:
+            logger.warning("Keeping checkpoint at %s: %s rows failed and will be retried next run", last_seen, failed)
+        else:
+            save_checkpoint(high_water)
+
+    wait_for_collection(client)
 
     duration = time.time() - start
-    logger.info("Ingest completed. processed=%s failed=%s duration_s=%.2f", processed, failed, duration)
+    logger.info(
+        "Ingest completed. processed=%s skipped=%s failed=%s duration_s=%.2f", processed, skipped, failed, duration
+    )
     return processed, failed
 
 
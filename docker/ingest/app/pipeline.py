@@ -0,0 +1,305 @@
+import logging
+import math
+import os
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from decimal import Decimal
+from typing import Iterator, Tuple
+
+import numpy as np
+import orjson
+import pandas as pd
+import requests
+from pyspark import TaskContext
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as qmodels
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Executor-side half of the ingest job. It lives in its own module so Spark
+# workers import it by name instead of cloudpickling app.py's globals; that
+# keeps the cached clients below per worker process.
+
+logger = logging.getLogger("spark-qdrant-ingest")
+
+ID_COLUMN = os.getenv("ID_COLUMN", "id")
+TEXT_COLUMN = os.getenv("TEXT_COLUMN", "text")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "64"))
+MAX_INFLIGHT = max(1, int(os.getenv("MAX_INFLIGHT", "4")))
+VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", "768"))
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "embeddings")
+QDRANT_HOST = os.getenv("QDRANT_HOST", "databases-qdrant")
+QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_URL = os.getenv("QDRANT_URL", "")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
+# Leave empty to embed in-process on the executor instead of calling the API
+EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://embedding-api:8000")
+EMBEDDING_BATCH_ENDPOINT = EMBEDDING_API_URL.rstrip("/") + "/encode_batch_bin"
+MODEL_NAME = os.getenv("MODEL_NAME", "all-mpnet-base-v2")
+# Same graph selection as the embedding API's EMBED_BACKEND=onnx, so local and
+# remote vectors match when the API runs that backend (other backends differ).
+# Pin ONNX_FILE on both when executor and API hosts differ in VNNI support.
+ONNX_FILE = os.getenv("ONNX_FILE", "")
+ONNX_FILE_VNNI = os.getenv("ONNX_FILE_VNNI", "onnx/model_qint8_avx512_vnni.onnx")
+ONNX_FILE_FALLBACK = os.getenv("ONNX_FILE_FALLBACK", "onnx/model_O3.onnx")
+# ORT intra-op threads per worker; 0 uses the task's spark.task.cpus share
+LOCAL_MODEL_THREADS = int(os.getenv("LOCAL_MODEL_THREADS", "0"))
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
+# skipped counts rows with no text; failed counts rows lost to embedding or upsert errors
+STATS_SCHEMA = "processed long, skipped long, failed long"
+# Namespace for ids derived from row contents when the id column is empty
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "spark-qdrant-ingest")
+
+# Per-process clients, reused by every partition the Python worker runs
+_session = None
+_client = None
+_model = None
+_lock = threading.Lock()
+# One forward pass at a time per worker; ORT already spreads it over its threads
+_encode_lock = threading.Lock()
+
+
+def qdrant_client_kwargs() -> dict:
+    grpc = {"prefer_grpc": True, "grpc_port": QDRANT_GRPC_PORT}
+    if QDRANT_URL:
+        return {"url": QDRANT_URL, "api_key": QDRANT_API_KEY or None, **grpc}
+    return {"host": QDRANT_HOST, "port": QDRANT_PORT, "api_key": QDRANT_API_KEY or None, **grpc}
+
+
+def get_client() -> QdrantClient:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = QdrantClient(**qdrant_client_kwargs())
+    return _client
+
+
+def build_session() -> requests.Session:
+    session = requests.Session()
+    # Encoding is idempotent, so transient gateway errors are safe to retry on POST
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+    adapter = HTTPAdapter(pool_connections=MAX_INFLIGHT, pool_maxsize=MAX_INFLIGHT * 2, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive", "Content-Type": "application/json"})
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def cpu_supports_vnni() -> bool:
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            return "avx512_vnni" in f.read()
+    except OSError:
+        return False
+
+
+def select_onnx_file() -> str:
+    if ONNX_FILE:
+        return ONNX_FILE
+    return ONNX_FILE_VNNI if cpu_supports_vnni() else ONNX_FILE_FALLBACK
+
+
+def local_model_threads() -> int:
+    # Under local[*] every core runs its own Python worker, so sizing each
+    # worker's ORT pool to the whole host would oversubscribe it
+    if LOCAL_MODEL_THREADS > 0:
+        return LOCAL_MODEL_THREADS
+    context = TaskContext.get()
+    return context.cpus() if context is not None else 1
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                import onnxruntime as ort
+                from sentence_transformers import SentenceTransformer
+
+                session_options = ort.SessionOptions()
+                session_options.intra_op_num_threads = local_model_threads()
+                # Same session settings as the embedding API
+                session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session_options.add_session_config_entry("session.dynamic_block_base", "4")
+                _model = SentenceTransformer(
+                    MODEL_NAME,
+                    backend="onnx",
+                    model_kwargs={
+                        "file_name": select_onnx_file(),
+                        "provider": "CPUExecutionProvider",
+                        "session_options": session_options,
+                    },
+                )
+    return _model
+
+
+def encode_local(texts: list):
+    try:
+        with _encode_lock:
+            return get_model().encode(texts, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True)
+    except Exception as exc:
+        logger.error("Error encoding batch locally: %s", exc)
+    return None
+
+
+def fetch_embeddings_batch(session: requests.Session, texts: list):
+    try:
+        response = session.post(EMBEDDING_BATCH_ENDPOINT, data=orjson.dumps({"texts": texts}), timeout=REQUEST_TIMEOUT)
+        if response.ok:
+            content = response.content
+            count = int.from_bytes(content[:4], "little")
+            if count != len(texts) or len(content) != 4 + count * VECTOR_SIZE * 4:
+                logger.error("Embedding API returned %s bytes for %s texts.", len(content), len(texts))
+                return None
+            return np.frombuffer(content, dtype="<f4", offset=4).reshape(count, VECTOR_SIZE)
+        logger.error("Embedding API returned status %s: %s", response.status_code, response.text)
+    except Exception as exc:
+        logger.error("Error calling embedding API: %s", exc)
+    return None
+
+
+def flush_points(client: QdrantClient, ids: list, vectors: list, payloads: list, wait_applied: bool = False) -> None:
+    if not ids:
+        return
+    client.upsert(
+        collection_name=QDRANT_COLLECTION,
+        wait=wait_applied,
+        points=qmodels.Batch(ids=ids, vectors=vectors, payloads=payloads),
+    )
+
+
+def embed_and_upsert(
+    client: QdrantClient,
+    session: requests.Session,
+    texts: list,
+    ids: list,
+    payloads: list,
+    wait_applied: bool = False,
+) -> Tuple[int, int]:
+    if EMBEDDING_API_URL:
+        embeddings = fetch_embeddings_batch(session, texts)
+    else:
+        embeddings = encode_local(texts)
+    if embeddings is None:
+        return 0, len(texts)
+
+    try:
+        flush_points(client, ids, embeddings.tolist(), payloads, wait_applied)
+    except Exception as exc:
+        logger.error("Error writing batch to Qdrant: %s", exc)
+        return 0, len(ids)
+    return len(ids), 0
+
+
+def is_missing(value) -> bool:
+    return value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and math.isnan(value))
+
+
+def resolve_ids(values: list, payloads: list) -> list:
+    # Derive missing ids from the row itself so a retried run overwrites the
+    # points it already wrote instead of adding duplicates
+    for i, value in enumerate(values):
+        if is_missing(value) or not value:
+            row = orjson.dumps(payloads[i], default=str, option=orjson.OPT_SORT_KEYS)
+            values[i] = uuid.uuid5(ID_NAMESPACE, row.decode())
+    return [str(value) for value in values]
+
+
+def to_payload_value(value):
+    # Arrow hands ArrayType as ndarray and DecimalType as Decimal; gRPC payloads take neither
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: to_payload_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_payload_value(v) for v in value]
+    return value
+
+
+def build_payloads(rows: pd.DataFrame) -> list:
+    payloads = rows.astype(object).where(rows.notna(), None)
+    # Only object columns can hold arrays, structs or decimals; numeric ones convert natively
+    for column in rows.columns[rows.dtypes == object]:
+        # Built with dtype=object so pandas cannot coerce the None values back to NaN
+        converted = [to_payload_value(value) for value in payloads[column]]
+        payloads[column] = pd.Series(converted, index=payloads.index, dtype=object)
+    return payloads.to_dict(orient="records")
+
+
+def process_partition(batches: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    session = get_session()
+    client = get_client()
+    processed = 0
+    skipped = 0
+    failed = 0
+    pending_texts = []
+    pending_ids = []
+    pending_payloads = []
+    inflight = set()
+
+    with ThreadPoolExecutor(max_workers=MAX_INFLIGHT) as executor:
+        for pdf in batches:
+            texts = pdf[TEXT_COLUMN]
+            texts = texts[texts.notna()].astype(str).str.strip()
+            texts = texts[texts != ""]
+            skipped += len(pdf) - len(texts)
+            if texts.empty:
+                continue
+
+            rows = pdf.loc[texts.index]
+            pending_texts.extend(texts.tolist())
+            payloads = build_payloads(rows)
+            pending_ids.extend(resolve_ids(rows[ID_COLUMN].tolist(), payloads))
+            pending_payloads.extend(payloads)
+
+            # Strictly greater: the partition's last rows are always left for the final flush below
+            while len(pending_texts) > BATCH_SIZE:
+                if len(inflight) >= MAX_INFLIGHT:
+                    done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch_processed, batch_failed = future.result()
+                        processed += batch_processed
+                        failed += batch_failed
+                inflight.add(
+                    executor.submit(
+                        embed_and_upsert,
+                        client,
+                        session,
+                        pending_texts[:BATCH_SIZE],
+                        pending_ids[:BATCH_SIZE],
+                        pending_payloads[:BATCH_SIZE],
+                    )
+                )
+                del pending_texts[:BATCH_SIZE], pending_ids[:BATCH_SIZE], pending_payloads[:BATCH_SIZE]
+
+        for future in wait(inflight).done:
+            batch_processed, batch_failed = future.result()
+            processed += batch_processed
+            failed += batch_failed
+
+    # Earlier batches went out with wait=False. Qdrant applies a collection's
+    # updates in order, so sending the last one with wait=True only returns
+    # once everything this partition upserted has been applied.
+    if pending_texts:
+        batch_processed, batch_failed = embed_and_upsert(
+            client, session, pending_texts, pending_ids, pending_payloads, wait_applied=True
+        )
+        processed += batch_processed
+        failed += batch_failed
+
+    yield pd.DataFrame({"processed": [processed], "skipped": [skipped], "failed": [failed]})
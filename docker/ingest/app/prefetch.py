@@ -0,0 +1,10 @@
+# prefetch.py
+# Run at image build time when local embedding is enabled, so the ONNX graphs
+# are already in the Hugging Face cache and local[*] workers never download them.
+from sentence_transformers import SentenceTransformer
+
+from pipeline import MODEL_NAME, ONNX_FILE, ONNX_FILE_FALLBACK, ONNX_FILE_VNNI
+
+if __name__ == "__main__":
+    for file_name in dict.fromkeys(filter(None, (ONNX_FILE, ONNX_FILE_VNNI, ONNX_FILE_FALLBACK))):
+        SentenceTransformer(MODEL_NAME, backend="onnx", model_kwargs={"file_name": file_name})
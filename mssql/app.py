@@ -1,10 +1,14 @@
 import os
 import uuid
-import json
+import ijson
 import pyodbc
 import datetime as dt
+from itertools import islice
 from pathlib import Path
 
+# Rows per executemany call; bounds the parameter array fast_executemany allocates
+INSERT_CHUNK_SIZE = int(os.getenv("MSSQL_INSERT_CHUNK_SIZE", "1000"))
+
 
 def load_dotenv(env_path: Path) -> None:
     """Minimal .env loader so the script can read the same values docker-compose uses."""
@@ -100,11 +104,38 @@ def parse_dt(value):
     """
     Parses ISO-8601 datetime strings or returns None.
     """
-    if value is None:
-        return None
-    if isinstance(value, dt.datetime):
+    if isinstance(value, str):
+        return dt.datetime.fromisoformat(value)
+    if value is None or isinstance(value, dt.datetime):
         return value
-    return dt.datetime.fromisoformat(value)
+    raise TypeError(f"Unsupported datetime value: {value!r}")
+
+
+def iter_params(path: Path):
+    """
+    Streams the JSON array at path and yields one INSERT parameter tuple per record.
+    """
+    with path.open("rb") as f:
+        events = ijson.parse(f, use_float=True)
+        if next(events, (None, None, None))[1] != "start_array":
+            raise ValueError("sample.json must contain a JSON array")
+
+        for r in ijson.items(events, "item"):
+            crime_uuid = r.get("crime_uuid")
+            yield (
+                uuid.UUID(crime_uuid) if crime_uuid else uuid.uuid4(),
+                parse_dt(r["occurred_at"]),
+                parse_dt(r.get("reported_at")),
+                r["offense_type"],
+                r.get("description"),
+                r.get("country"),
+                r.get("state_province"),
+                r.get("city"),
+                r.get("address"),
+                r.get("latitude"),
+                r.get("longitude"),
+                r.get("source_system"),
+            )
 
 
 def insert_sample_rows(
@@ -116,14 +147,10 @@ def insert_sample_rows(
     if not path.exists():
         raise FileNotFoundError(f"JSON file not found: {json_path}")
 
-    with path.open("r", encoding="utf-8") as f:
-        rows = json.load(f)
-
-    if not isinstance(rows, list):
-        raise ValueError("sample.json must contain a JSON array")
-
     cur = conn.cursor()
     cur.fast_executemany = True
+    # Skip the per-statement DONE_IN_PROC row counts
+    cur.execute("SET NOCOUNT ON")
 
     sql = """
     INSERT INTO dbo.Crimes (
@@ -133,29 +160,14 @@ def insert_sample_rows(
     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
 
-    params = []
-    for r in rows:
-        params.append(
-            (
-                uuid.UUID(r["crime_uuid"]) if r.get("crime_uuid") else uuid.uuid4(),
-                parse_dt(r["occurred_at"]),
-                parse_dt(r.get("reported_at")),
-                r["offense_type"],
-                r.get("description"),
-                r.get("country"),
-                r.get("state_province"),
-                r.get("city"),
-                r.get("address"),
-                r.get("latitude"),
-                r.get("longitude"),
-                r.get("source_system"),
-            )
-        )
-
-    cur.executemany(sql, params)
+    inserted = 0
+    params = iter_params(path)
+    while chunk := list(islice(params, INSERT_CHUNK_SIZE)):
+        cur.executemany(sql, chunk)
+        inserted += len(chunk)
     conn.commit()
 
-    print(f"✅ Inserted {len(params)} rows from {json_path}")
+    print(f"✅ Inserted {inserted} rows from {json_path}")
 
 
 def main() -> None: